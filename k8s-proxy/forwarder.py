@@ -79,7 +79,9 @@ def _guess_namespace() -> typing.Optional[str]:
 
 
 def listen(client):
-    reactor.listenTCP(9050, socks.SOCKSv5Factory())
+    # Clients open many short-lived tunnels at once; don't let bursts of
+    # connection attempts overflow Twisted's default backlog of 50.
+    reactor.listenTCP(9050, socks.SOCKSv5Factory(), backlog=1024)
     factory = server.DNSServerFactory(clients=[client])
     protocol = dns.DNSDatagramProtocol(controller=factory)
 
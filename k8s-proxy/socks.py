@@ -17,19 +17,30 @@ for RESOLVE extension.
 import socket
 import struct
 import os
-from typing import Tuple, Callable, Type, Optional, Any
+import time
+from typing import Dict, Tuple, Callable, Type, Optional, Any
 
 # twisted imports
 from twisted.internet import reactor, protocol
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.threads import deferToThread
 from twisted.python import log
-from twisted.protocols.stateful import StatefulProtocol
 from twisted.internet.error import ConnectionRefusedError, DNSLookupError
 
 DEBUG = "DEBUG_SOCKS" in os.environ
 
-NextState = Optional[Tuple[Callable, int]]
+# Pre-compiled wire formats: a port number and a reply header.
+_U16 = struct.Struct("!H")
+_HDR = struct.Struct("!BBBB")
+
+# The unspecified address sent back with error responses.
+_NO_ADDRESS = socket.inet_aton("0.0.0.0")
+
+# Recently resolved names, mapping hostname to (address, packed address,
+# expiry time).
+DNS_CACHE_TTL = 30.0
+DNS_CACHE_SIZE = 1024
+_DNS_CACHE = {}  # type: Dict[str, Tuple[str, bytes, float]]
 
 
 class SOCKSv5Outgoing(protocol.Protocol):
@@ -43,6 +54,12 @@ class SOCKSv5Outgoing(protocol.Protocol):
         # First thing, make sure SOCKS connection knows about us, so events get
         # handed to us:
         self.socks.otherConn = self
+        # Each transport produces data for the other one; registering them as
+        # streaming producers lets the reactor pause reading on one side while
+        # the other side's write buffer is full, instead of buffering without
+        # bound in memory.
+        self.transport.registerProducer(self.socks.transport, True)
+        self.socks.transport.registerProducer(self.transport, True)
         # Next, tell SOCKS client it can now proceed to send data via the
         # server to this connection. Per the RFC, we return the bind host and
         # port.
@@ -56,6 +73,9 @@ class SOCKSv5Outgoing(protocol.Protocol):
         self.socks.write(data)
 
     def write(self, data: bytes):
+        # No coalescing is needed here: the transport only buffers the chunk
+        # and sends everything pending in one go when the socket becomes
+        # writable, so several chunks per reactor iteration cost one syscall.
         self.transport.write(data)
 
 
@@ -63,15 +83,49 @@ def reverse_resolve(name: str) -> Deferred:
     return deferToThread(lambda: socket.gethostbyaddr(name)[0])
 
 
-class SOCKSv5(StatefulProtocol):
+def cached_address(name: str) -> Optional[Tuple[str, bytes]]:
+    """
+    Return the cached address for a hostname and its packed form, if it
+    hasn't expired.
+    """
+    entry = _DNS_CACHE.get(name)
+    if entry is not None and entry[2] > time.monotonic():
+        return entry[0], entry[1]
+    return None
+
+
+def cached_resolve(reactor: Any, name: str) -> Deferred:
+    """
+    Resolve a hostname with the reactor, reusing answers that are less than
+    DNS_CACHE_TTL seconds old. Failures are not cached.
+
+    The result is the address and its packed form.
+    """
+    cached = cached_address(name)
+    if cached is not None:
+        return succeed(cached)
+
+    def remember(address: str) -> Tuple[str, bytes]:
+        packed = socket.inet_aton(address)
+        if len(_DNS_CACHE) >= DNS_CACHE_SIZE:
+            _DNS_CACHE.clear()
+        expiry = time.monotonic() + DNS_CACHE_TTL
+        _DNS_CACHE[name] = (address, packed, expiry)
+        return address, packed
+
+    return reactor.resolve(name).addCallback(remember)
+
+
+class SOCKSv5(protocol.Protocol):
     """
     An implementation of the SOCKSv5 protocol.
 
     @type reactor: object providing L{twisted.internet.interfaces.IReactorTCP}
     @ivar reactor: The reactor used to create connections.
 
-    @type buf: L{str}
-    @ivar buf: Part of a SOCKSv5 connection request.
+    @type _hs_buf: L{bytearray} or L{None}
+    @ivar _hs_buf: The part of the handshake and request received so far.
+        L{None} once the request has been parsed.
 
     @type otherConn: C{SOCKSv5Incoming}, C{SOCKSv5Outgoing} or L{None}
     @ivar otherConn: Until the connection has been established, C{otherConn} is
@@ -87,6 +141,9 @@ class SOCKSv5(StatefulProtocol):
     def connectionMade(self) -> None:
         self.otherConn = None  # type: Optional[SOCKSv5Outgoing]
         self.command = None  # type: Optional[str]
+        self._hs_buf = bytearray()  # type: Optional[bytearray]
+        self._authenticated = False
+        self._methods_left = 0
 
     def dataReceived(self, data: bytes) -> None:
         """
@@ -96,35 +153,51 @@ class SOCKSv5(StatefulProtocol):
         @param data: Part or all of a SOCKSv5 packet.
         """
         if DEBUG:
-            print("RECEIVED:", repr(data))
+            log.msg(format="RECEIVED %(length)d bytes", length=len(data))
         if self.otherConn is not None:
             # We're in proxying mode now:
             self.otherConn.write(data)
             return
-        StatefulProtocol.dataReceived(self, data)
-
-    def getInitialState(self) -> NextState:
-        """Starting point for parsing state machine."""
-        return self._parse_handshake_start, 2
-
-    def _parse_handshake_start(self, data: bytes) -> NextState:
+        if self._hs_buf is None:
+            # The request has been parsed and we're waiting for the outcome.
+            # Clients must wait for our response before sending anything, so
+            # there is nothing useful to do with this data.
+            return
+        buf = self._hs_buf
+        buf += data
+        if not self._authenticated:
+            self._parse_handshake(buf)
+        if self._methods_left:
+            # Swallow the authentication methods we've already answered.
+            skipped = min(len(buf), self._methods_left)
+            del buf[:skipped]
+            self._methods_left -= skipped
+        if self._authenticated and not self._methods_left:
+            self._parse_request(buf)
+
+    def _parse_handshake(self, buf: bytearray) -> None:
         """Parse the first two bytes of the handshake request."""
-        assert data[0] == 5
-        length = data[1]
-        return self._parse_handshake_auth, length
-
-    def _parse_handshake_auth(self, data: bytes) -> NextState:
-        """Parse the authentication methods bytes of the handshake request."""
-        # NO_AUTH response
+        if len(buf) < 2:
+            return
+        if buf[0] != 5:
+            self._drop_malformed()
+            return
+        # The authentication methods are ignored, so the NO_AUTH response can
+        # go out without waiting for them.
         self.write(b"\x05\x00")
-        return self._parse_request_start, 4
-
-    def _parse_request_start(self, data: bytes) -> NextState:
-        """Parse the start of the request."""
-        assert data[0] == 5
-        assert data[2] == 0
-        command = data[1]
-        addr_type = data[3]
+        self._methods_left = buf[1]
+        del buf[:2]
+        self._authenticated = True
+
+    def _parse_request(self, buf: bytearray) -> None:
+        """Parse the request once all of it has arrived."""
+        if len(buf) < 4:
+            return
+        if buf[0] != 5 or buf[2] != 0:
+            self._drop_malformed()
+            return
+        command = buf[1]
+        addr_type = buf[3]
         if command == 1:
             self.command = "CONNECT"
         elif command == 240:  # \xF0
@@ -133,37 +206,37 @@ class SOCKSv5(StatefulProtocol):
             self.command = "RESOLVE_PTR"
         else:
             # Unsupported command response
-            self._write_response(7, "0.0.0.0", 0)
-            return None
+            self._write_response_packed(7, _NO_ADDRESS, 0)
+            return
 
         if addr_type == 1:
-            return self._parse_request_ipv4, 6
-        if addr_type == 3:
-            return self._parse_request_domainname_start, 1
+            # IPv4 address and port
+            end = 4 + 4 + 2
+        elif addr_type == 3:
+            # Length-prefixed domain name and port
+            if len(buf) < 5:
+                return
+            end = 4 + 1 + buf[4] + 2
         else:
             # XXX IPv6 currently unsupported
-            self._write_response(7, "0.0.0.0", 0)
-            return None
+            self._write_response_packed(7, _NO_ADDRESS, 0)
+            return
+        if len(buf) < end:
+            return
 
-    def _parse_request_ipv4(self, data: bytes) -> None:
-        """Parse the rest of the request if address type is IPv4."""
-        host = socket.inet_ntoa(data[:4])
-        port = struct.unpack("!H", data[4:6])[0]
+        with memoryview(buf) as view:
+            if addr_type == 1:
+                host = socket.inet_ntoa(view[4:8])
+            else:
+                host = str(view[5:end - 2], "utf-8")
+            port = _U16.unpack_from(view, end - 2)[0]
+        self._hs_buf = None
         self._done_parsing(host, port)
 
-    def _parse_request_domainname_start(self, data: bytes) -> NextState:
-        """
-        Parse the domain length part of the request if address type is a domain
-        name.
-        """
-        length = data[0]
-        return self._parse_request_domainname, length + 2
-
-    def _parse_request_domainname(self, data: bytes) -> None:
-        """Parse the rest of the request if address type is a domain name."""
-        host = str(data[:-2], "utf-8")
-        port = struct.unpack("!H", data[-2:])[0]
-        self._done_parsing(host, port)
+    def _drop_malformed(self) -> None:
+        """Close a connection whose handshake or request is not SOCKSv5."""
+        self._hs_buf = None
+        self.transport.loseConnection()
 
     def _handle_error(self, failure):
         """Handle errors in connecting or resolving."""
@@ -173,26 +246,34 @@ class SOCKSv5(StatefulProtocol):
             error_code = 4
         if failure.check(ConnectionRefusedError):
             error_code = 5
-        self._write_response(error_code, "0.0.0.0", 0)
+        self._write_response_packed(error_code, _NO_ADDRESS, 0)
 
     def _write_response(self, code: int, host: str, port: int) -> None:
         """Send a response to the client."""
-        self.write(
-            struct.pack("!BBBB", 5, code, 0, 1) + socket.inet_aton(host) +
-            struct.pack("!H", port)
-        )
+        self._write_response_packed(code, socket.inet_aton(host), port)
+
+    def _write_response_packed(
+        self, code: int, packed_host: bytes, port: int
+    ) -> None:
+        """Send a response to the client, given an already packed address."""
+        self.write(_HDR.pack(5, code, 0, 1) + packed_host + _U16.pack(port))
         if code != 0:
             self.transport.loseConnection()
 
     def _done_parsing(self, host: str, port: int) -> None:
         """Called when the request is completely finished parsing."""
         if self.command == "CONNECT":
+            # Connect to the address directly if we've just looked it up.
+            cached = cached_address(host)
+            if cached is not None:
+                host = cached[0]
             d = self.connectClass(str(host), port, SOCKSv5Outgoing, self)
             d.addErrback(self._handle_error)
         elif self.command == "RESOLVE":
 
-            def write_response(addr):
-                self.write(b"\5\0\0\1" + socket.inet_aton(addr))
+            def write_response(resolved):
+                _, packed_address = resolved
+                self.write(b"\5\0\0\1" + packed_address)
                 self.transport.loseConnection()
 
             def write_error(e):
@@ -200,7 +281,8 @@ class SOCKSv5(StatefulProtocol):
                 self.write(b"\5\4\0\0")
                 self.transport.loseConnection()
 
-            self.reactor.resolve(
+            cached_resolve(
+                self.reactor,
                 host,
             ).addCallback(write_response).addErrback(write_error)
         elif self.command == "RESOLVE_PTR":
@@ -230,16 +312,21 @@ class SOCKSv5(StatefulProtocol):
     def connectionLost(self, reason):
         if self.otherConn:
             self.otherConn.transport.loseConnection()
+        # Break the reference cycle with the outgoing connection so both
+        # protocol instances are freed right away rather than by the cyclic
+        # garbage collector.
+        self.otherConn = None
+        self._hs_buf = None
 
     def connectClass(
         self, host: str, port: int, klass: Type[protocol.Protocol], *args
     ) -> Any:
-        return protocol.ClientCreator(reactor, klass,
+        return protocol.ClientCreator(self.reactor, klass,
                                       *args).connectTCP(host, port)
 
     def write(self, data):
         if DEBUG:
-            print("SENT:", repr(data))
+            log.msg(format="SENT %(length)d bytes", length=len(data))
         self.transport.write(data)
 
 
@@ -247,16 +334,22 @@ class SOCKSv5Factory(protocol.Factory):
     """
     A factory for a SOCKSv5 proxy.
 
-    Constructor accepts one argument, a log file name.
+    @type reactor: object providing L{twisted.internet.interfaces.IReactorTCP}
+    @ivar reactor: The reactor shared by all the protocol instances.
     """
 
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+
     def buildProtocol(self, addr):
-        return SOCKSv5(reactor)
+        return SOCKSv5(reactor=self.reactor)
 
 
 if __name__ == '__main__':
+    import sys
     DEBUG = True
     from twisted.python.failure import startDebugMode
+    log.startLogging(sys.stdout)
     startDebugMode()
     reactor.listenTCP(9050, SOCKSv5Factory())  # type: ignore
     reactor.run()  # type: ignore
@@ -135,12 +135,26 @@ class FakeReverseResolverTest(ReverseResolveTestsMixin, unittest.TestCase):
     }).reverse_resolve
 
 
+class FactoryTests(unittest.TestCase):
+    def test_buildProtocol(self):
+        """
+        The factory hands its reactor to every protocol instance it builds.
+        """
+        reactor = FakeResolverReactor({})
+        factory = socks.SOCKSv5Factory(reactor)
+        proto = factory.buildProtocol(IPv4Address('TCP', '1.2.3.4', 5678))
+        self.assertIsInstance(proto, socks.SOCKSv5)
+        self.assertIs(proto.reactor, reactor)
+
+
 class ConnectTests(unittest.TestCase):
     """
     Tests for SOCKSv5 connect requests using the L{SOCKSv5} protocol.
     """
 
     def setUp(self):
+        socks._DNS_CACHE.clear()
+        self.addCleanup(socks._DNS_CACHE.clear)
         self.dns = {
             "example.com": "5.6.7.8",
             "1.2.3.4": "1.2.3.4"
@@ -317,6 +331,77 @@ class ConnectTests(unittest.TestCase):
             self.sock.driver_outgoing.transport.stringTCPTransport_closing
         )
 
+    def test_handshakeEagerReply(self):
+        """
+        The server replies NO_AUTH as soon as it knows the protocol version,
+        without waiting for the list of authentication methods.
+        """
+        self.sock.dataReceived(struct.pack("!BB", 5, 2))
+        self.assertEqual(self.sock.transport.value(), struct.pack("!BB", 5, 0))
+        self.sock.transport.clear()
+
+        # The methods are then skipped before the request is parsed.
+        self.deliver_data(self.sock, struct.pack("!BB", 0, 2))
+        self.assertEqual(self.sock.transport.value(), b"")
+        self.assert_connect('1.2.3.4', 34, "2.3.4.5", 42)
+
+    def test_handshakeAndRequestInOneChunk(self):
+        """
+        The handshake and request can arrive together in a single chunk.
+        """
+        self.sock.dataReceived(
+            struct.pack("!BBB", 5, 1, 0) +
+            struct.pack("!BBBB", 5, 1, 0, 1) +
+            socket.inet_aton("1.2.3.4") +
+            struct.pack("!H", 34)
+        )
+        self.assertEqual(
+            self.sock.transport.value(),
+            struct.pack("!BB", 5, 0) +
+            struct.pack("!BBBB", 5, 0, 0, 1) +
+            socket.inet_aton("2.3.4.5") +
+            struct.pack("!H", 42)
+        )
+        self.assertEqual(
+            self.sock.driver_outgoing.transport.getPeer(),
+            IPv4Address('TCP', '1.2.3.4', 34)
+        )
+
+    def test_handshakeWrongVersion(self):
+        """
+        A handshake for a protocol version other than 5 closes the connection
+        without a reply.
+        """
+        self.deliver_data(self.sock, struct.pack("!BBB", 4, 1, 0))
+        self.assertEqual(self.sock.transport.value(), b"")
+        self.assertTrue(self.sock.transport.stringTCPTransport_closing)
+
+    def assert_malformed_request(self, version, reserved):
+        """
+        A malformed request closes the connection without a reply.
+        """
+        self.assert_handshake()
+        self.deliver_data(
+            self.sock,
+            struct.pack("!BBBB", version, 1, reserved, 1) +
+            socket.inet_aton("1.2.3.4") + struct.pack("!H", 34)
+        )
+        self.assertEqual(self.sock.transport.value(), b"")
+        self.assertTrue(self.sock.transport.stringTCPTransport_closing)
+        self.assertIsNone(self.sock.driver_outgoing)
+
+    def test_requestWrongVersion(self):
+        """
+        A request for a protocol version other than 5 is rejected.
+        """
+        self.assert_malformed_request(4, 0)
+
+    def test_requestNonZeroReserved(self):
+        """
+        A request with a non-zero reserved byte is rejected.
+        """
+        self.assert_malformed_request(5, 1)
+
     def test_socks5SuccessfulResolution(self):
         """
         Socks5 also supports hostname-based connections.
@@ -326,6 +411,20 @@ class ConnectTests(unittest.TestCase):
         self.assert_handshake()
         self.assert_resolve("example.com", "5.6.7.8")
 
+    def test_socks5CachedResolution(self):
+        """
+        A repeated resolution is answered from the cache without asking the
+        reactor again.
+        """
+        self.assert_handshake()
+        self.assert_resolve("example.com", "5.6.7.8")
+
+        del self.dns["example.com"]
+        self.sock = SOCKSv5Driver(self.reactor)
+        self.sock.makeConnection(StringTCPTransport())
+        self.assert_handshake()
+        self.assert_resolve("example.com", "5.6.7.8")
+
     def test_socks5TorStyleFailedResolution(self):
         """
         A Tor-style name resolution when resolution fails.
@@ -433,6 +532,20 @@ class ConnectTests(unittest.TestCase):
         self.assertTrue(self.sock.transport.stringTCPTransport_closing)
         self.assertEqual(len(self.flushLoggedErrors(socket.herror)), 1)
 
+    def test_flowControl(self):
+        """
+        Once connected, each transport is registered as a streaming producer
+        for the other.
+        """
+        self.assert_handshake()
+        self.assert_connect('1.2.3.4', 34, "2.3.4.5", 42)
+
+        outgoing_transport = self.sock.driver_outgoing.transport
+        self.assertIs(outgoing_transport.producer, self.sock.transport)
+        self.assertTrue(outgoing_transport.streaming)
+        self.assertIs(self.sock.transport.producer, outgoing_transport)
+        self.assertTrue(self.sock.transport.streaming)
+
     def test_eofRemote(self):
         """If the outgoing connection closes the client connection closes."""
         self.assert_handshake()
@@ -451,3 +564,4 @@ class ConnectTests(unittest.TestCase):
         self.assertTrue(
             self.sock.driver_outgoing.transport.stringTCPTransport_closing
         )
+        self.assertIsNone(self.sock.otherConn)
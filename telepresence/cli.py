@@ -19,7 +19,9 @@ from contextlib import contextmanager
 from pathlib import Path
 from subprocess import check_output
 from traceback import format_exc
-from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+from typing import (
+    Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+)
 from urllib.parse import quote_plus
 
 import telepresence
@@ -44,7 +46,7 @@ class PortMapping(object):
             result._mapping[local_port] = remote_port
         return result
 
-    def merge_automatic_ports(self, ports: List[int]) -> None:
+    def merge_automatic_ports(self, ports: Iterable[int]) -> None:
         """
         Merge a list of ports to the existing ones.
 
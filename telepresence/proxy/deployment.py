@@ -25,6 +25,7 @@ from telepresence import (
 from telepresence.cli import PortMapping
 from telepresence.runner import Runner
 
+from .manifest import encode_manifest
 from .remote import get_deployment
 
 
@@ -363,7 +364,7 @@ def supplant_deployment(
     delete_new_deployment(False)  # Just in case
     runner.check_call(
         runner.kubectl("apply", "-f", "-"),
-        input=json.dumps(new_deployment_json).encode("utf-8")
+        input=encode_manifest(new_deployment_json)
     )
 
     # Scale down the original deployment
@@ -430,10 +431,7 @@ def new_swapped_deployment(
                 "args", "startupProbe", "livenessProbe", "readinessProbe",
                 "workingDir", "lifecycle"
             ]:
-                try:
-                    container.pop(unneeded)
-                except KeyError:
-                    pass
+                container.pop(unneeded, None)
             # Set running command explicitly
             container["command"] = ["/usr/src/app/run.sh"]
             # We don't write out termination file:
@@ -510,7 +508,7 @@ def swap_deployment_openshift(
     def apply_json(json_config):
         runner.check_call(
             runner.kubectl("replace", "-f", "-"),
-            input=json.dumps(json_config).encode("utf-8")
+            input=encode_manifest(json_config)
         )
         # Now that we've updated the deployment config,
         # let's rollout latest version to apply the changes
@@ -12,11 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 from typing import Any, Dict, Iterable
 
+# Use orjson to encode manifests when it happens to be installed. It returns
+# UTF-8 bytes directly. Telepresence itself only depends on the standard
+# library.
+try:
+    from orjson import dumps as _json_dumps  # type: ignore
+except ImportError:
+
+    def _json_dumps(obj: Any) -> bytes:
+        # The output is ASCII-only (ensure_ascii), so this is a single copy.
+        return json.dumps(obj).encode("utf-8")
+
+
 Manifest = Dict[str, Any]
 
 
+def encode_manifest(manifest: Manifest) -> bytes:
+    """Encode a manifest as JSON, ready to be fed to kubectl."""
+    return _json_dumps(manifest)
+
+
 def make_k8s_list(items: Iterable[Manifest]) -> Manifest:
     return {
         "apiVersion": "v1",
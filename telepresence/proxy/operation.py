@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 from subprocess import CalledProcessError
 from typing import Any, Dict, Iterable, List, NamedTuple
 
@@ -22,8 +21,8 @@ from telepresence.runner import Runner
 
 from .deployment import get_image_name
 from .manifest import (
-    Manifest, make_k8s_list, make_new_proxy_pod_manifest, make_pod_manifest,
-    make_svc_manifest
+    Manifest, encode_manifest, make_k8s_list, make_new_proxy_pod_manifest,
+    make_pod_manifest, make_svc_manifest
 )
 from .remote import (
     RemoteInfo, get_deployment, get_pod_for_deployment,
@@ -40,6 +39,14 @@ ProxyIntent = NamedTuple(
     ]
 )
 
+PreparedManifests = NamedTuple(
+    "PreparedManifests", [
+        ("manifest_json", bytes),
+        ("kinds_display", str),
+        ("kinds_csv", str),
+    ]
+)
+
 
 class ProxyOperation:
     """Base class for proxy operation implementations."""
@@ -61,21 +68,33 @@ class ProxyOperation:
         raise NotImplementedError()
 
 
-def create_with_cleanup(runner: Runner, manifests: Iterable[Manifest]) -> None:
+def prepare_manifests(manifests: Iterable[Manifest]) -> PreparedManifests:
+    """Encode manifests for create_with_cleanup.
+
+    This will be called in the intent phase, so the action phase only has to
+    talk to the cluster.
+    """
+    manifests = list(manifests)
+    kinds = sorted({
+        str(manifest["kind"]).capitalize()
+        for manifest in manifests
+    })
+    manifest_list = make_k8s_list(manifests)
+    manifest_json = encode_manifest(manifest_list)
+    return PreparedManifests(manifest_json, ", ".join(kinds), ",".join(kinds))
+
+
+def create_with_cleanup(runner: Runner, prepared: PreparedManifests) -> None:
     """Create resources and set up their removal at cleanup.
 
     Uses "kubectl create" with the supplied manifests to create resources.
     Assumes that all the created resources include the telepresence label so it
     can use a label selector to delete those resources.
     """
-    kinds = set(str(manifest["kind"]).capitalize() for manifest in manifests)
-    kinds_display = ", ".join(kinds)
-    manifest_list = make_k8s_list(manifests)
-    manifest_json = json.dumps(manifest_list)
+    kinds_display = prepared.kinds_display
     try:
         runner.check_call(
-            runner.kubectl("create", "-f", "-"),
-            input=manifest_json.encode("utf-8")
+            runner.kubectl("create", "-f", "-"), input=prepared.manifest_json
         )
     except CalledProcessError as exc:
         raise runner.fail(
@@ -90,7 +109,7 @@ def create_with_cleanup(runner: Runner, manifests: Iterable[Manifest]) -> None:
                 "--ignore-not-found",
                 "--wait=false",
                 "--selector=telepresence=" + runner.session_id,
-                ",".join(kinds),
+                prepared.kinds_csv,
             )
         )
 
@@ -123,6 +142,7 @@ class New(ProxyOperation):
             )
             self.manifests.append(svc)
 
+        self.prepared = prepare_manifests(self.manifests)
         self.remote_info = make_remote_info_from_pod(pod)
 
     def act(self, runner: Runner) -> RemoteInfo:
@@ -130,7 +150,7 @@ class New(ProxyOperation):
             "Starting network proxy to cluster using "
             "new Pod {}".format(self.intent.name)
         )
-        create_with_cleanup(runner, self.manifests)
+        create_with_cleanup(runner, self.prepared)
 
         wait_for_pod(runner, self.remote_info)
 
@@ -150,16 +170,12 @@ def find_container(pod_spec: Manifest, container_name: str) -> Manifest:
     return {}
 
 
-def set_expose_ports(
-    expose: PortMapping, pod: Manifest, container_name: str
-) -> None:
+def set_expose_ports(expose: PortMapping, container: Manifest) -> None:
     """Merge container ports into the expose list."""
-    pod_spec = pod["spec"]  # type: Manifest
-    container = find_container(pod_spec, container_name)
-    expose.merge_automatic_ports([
-        port["containerPort"] for port in container.get("ports", [])
+    expose.merge_automatic_ports(
+        port["containerPort"] for port in container.get("ports", ())
         if port["protocol"] == "TCP"
-    ])
+    )
 
 
 class Swap(ProxyOperation):
@@ -211,13 +227,14 @@ class Swap(ProxyOperation):
 
         empty_env = []  # type: List[Dict[str, Any]]
         container.setdefault("env", empty_env)
-        container["env"].extend(
-            dict(name=k, value=v) for k, v in self.intent.env.items()
-        )
+        new_env = [{
+            "name": k,
+            "value": v
+        } for k, v in self.intent.env.items()]  # type: List[Dict[str, Any]]
         # Add namespace environment variable to support deployments using
         # automountServiceAccountToken: false. To be used by forwarder.py
         # in the k8s-proxy.
-        container["env"].append({
+        new_env.append({
             "name": "TELEPRESENCE_CONTAINER_NAMESPACE",
             "valueFrom": {
                 "fieldRef": {
@@ -225,22 +242,21 @@ class Swap(ProxyOperation):
                 }
             }
         })
+        container["env"].extend(new_env)
 
         for unneeded in [
             "args", "livenessProbe", "startupProbe", "readinessProbe",
             "workingDir", "lifecycle"
         ]:
-            try:
-                container.pop(unneeded)
-            except KeyError:
-                pass
+            container.pop(unneeded, None)
 
         # Construct a Pod manifest
         pod = make_pod_manifest(pod_metadata, pod_spec)
         self.manifests.append(pod)
 
-        set_expose_ports(self.intent.expose, pod, self.intent.container)
+        set_expose_ports(self.intent.expose, container)
 
+        self.prepared = prepare_manifests(self.manifests)
         self.remote_info = make_remote_info_from_pod(pod)
 
     def act(self, runner: Runner) -> RemoteInfo:
@@ -259,7 +275,7 @@ class Swap(ProxyOperation):
                 )
             )
 
-        create_with_cleanup(runner, self.manifests)
+        create_with_cleanup(runner, self.prepared)
 
         # Scale down the original deployment
         runner.add_cleanup(
@@ -276,12 +292,15 @@ class Swap(ProxyOperation):
 class Existing(ProxyOperation):
     """Perform the existing deployment proxy operation."""
     def prepare(self, runner: Runner) -> None:
-        # Grab the existing deployment's pod config
+        # Grab the existing deployment's pod config. The pod search needs the
+        # labels from the deployment's pod template, so these two lookups
+        # cannot run concurrently.
         deployment = get_deployment(runner, self.intent.name)  # type: Manifest
         self.deployment_type = deployment["kind"]  # type: str
         pod = get_pod_for_deployment(runner, deployment)  # type: Manifest
 
-        set_expose_ports(self.intent.expose, pod, self.intent.container)
+        container = find_container(pod["spec"], self.intent.container)
+        set_expose_ports(self.intent.expose, container)
 
         self.remote_info = make_remote_info_from_pod(pod)
 
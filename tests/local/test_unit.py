@@ -17,6 +17,7 @@ Unit tests (in-memory, small units of code).
 
 import ipaddress
 import itertools
+import json
 import subprocess
 import sys
 import tempfile
@@ -32,6 +33,7 @@ import telepresence.outbound.container
 import telepresence.outbound.cidr
 import telepresence.outbound.vpn
 import telepresence.proxy.deployment
+import telepresence.proxy.operation
 import telepresence.runner.output
 from telepresence.runner.cache import Cache
 from telepresence.runner.kube import KubeInfo
@@ -289,6 +291,22 @@ def test_swap_deployment_changes():
     assert (8080, 8080) in ports.local_to_remote()
 
 
+def test_prepare_manifests():
+    """
+    Manifests are encoded once, with their kinds in a stable order, ahead of
+    being created.
+    """
+    manifests = [
+        dict(kind="service", metadata=dict(name="svc")),
+        dict(kind="Pod", metadata=dict(name="pod")),
+    ]
+    prepared = telepresence.proxy.operation.prepare_manifests(iter(manifests))
+    assert prepared.kinds_display == "Pod, Service"
+    assert prepared.kinds_csv == "Pod,Service"
+    expected = dict(apiVersion="v1", kind="List", items=manifests)
+    assert json.loads(prepared.manifest_json.decode("utf-8")) == expected
+
+
 def test_portmapping():
     """
     Manually set exposed ports always override automatically exposed ports.